@@ -20,6 +20,10 @@ import gspread
 from google.oauth2.service_account import Credentials
 from gspread_asyncio import AsyncioGspreadClientManager
 import json
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from screenshot_analysis import analyze_screenshot, OCR_AVAILABLE
 
 
 # --- CONFIGURAZIONE e VARIABILI D'AMBIENTE ---
@@ -276,7 +280,245 @@ async def update_user_status(row_number: int, new_status: str):
     except Exception as e:
         logger.error(f"SHEETS: Errore durante l'aggiornamento dello stato per riga {row_number}: {type(e).__name__} - {e}")
         return False
-        
+
+# --- RICONCILIAZIONE PERIODICA TRA PERSISTENZA E FOGLIO ---
+
+# Colonne del foglio usate dalla riconciliazione (numerazione da 1, come in gspread).
+EMAIL_COLUMN = 4        # Colonna D: Mail Personale
+USERNAME_COLUMN = 5     # Colonna E: @username
+ONBOARDING_COLUMN = 14  # Colonna N: ONBOARDING
+RECONCILIATION_INTERVAL = 30 * 60  # Ogni 30 minuti
+
+# Stato del bot -> valore atteso nella colonna ONBOARDING.
+# Gli stati non presenti qui (es. 'awaiting_email') non vengono riconciliati.
+STATE_TO_ONBOARDING = {
+    'awaiting_screenshot': "TEST INVIATO",
+    'awaiting_username': "TEST INVIATO",
+    'awaiting_verification': "TEST INVIATO",
+    'expired': "TEST SCADUTO",
+}
+# Valori che il bot può sovrascrivere. Qualsiasi altro valore è stato scritto
+# a mano dal team e non va toccato.
+BOT_MANAGED_ONBOARDING = {"", "IN ATTESA DI TEST", *STATE_TO_ONBOARDING.values()}
+
+async def reconciliation_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Allinea il foglio Google con lo stato salvato nella persistenza.
+    Legge tutto il foglio con una sola chiamata, confronta in memoria usando
+    l'email come chiave (i numeri di riga possono cambiare) e scrive tutte le
+    correzioni con un unico batch_update.
+    """
+    logger.info("SHEETS: Inizio riconciliazione periodica.")
+    try:
+        agc = await agc_manager.authorize()
+        spreadsheet = await agc.open_by_url(SPREADSHEET_URL)
+        worksheet = await spreadsheet.get_worksheet(0)
+        all_rows = await worksheet.get_all_values()
+    except Exception as e:
+        logger.error(f"SHEETS: Errore durante la lettura del foglio per la riconciliazione: {type(e).__name__} - {e}")
+        return
+
+    # Indice email -> (numero di riga, valore ONBOARDING attuale)
+    rows_by_email = {}
+    for row_number, row in enumerate(all_rows, start=1):
+        if len(row) < EMAIL_COLUMN:
+            continue
+        email = row[EMAIL_COLUMN - 1].strip().lower()
+        if not email or email in rows_by_email:
+            continue
+        onboarding = row[ONBOARDING_COLUMN - 1].strip() if len(row) >= ONBOARDING_COLUMN else ""
+        rows_by_email[email] = (row_number, onboarding)
+
+    # Email -> user_id che la usa già come chiave: un'email appartiene a un solo utente
+    claimed_emails = {}
+    for user_id, data in context.application.user_data.items():
+        if data.get('email'):
+            claimed_emails.setdefault(data['email'], user_id)
+
+    cell_updates = []
+    updated_rows = set()
+    moved_user_ids = []
+    skipped_users = 0
+    for user_id, data in context.application.user_data.items():
+        email = data.get('email')
+        if not email:
+            # Utenti registrati prima che salvassimo l'email: la recuperiamo una
+            # sola volta dalla riga salvata, ma solo se quella riga ha ancora il
+            # loro @username (la riga potrebbe essersi spostata).
+            sheet_row = data.get('sheet_row')
+            row = all_rows[sheet_row - 1] if sheet_row and 1 <= sheet_row <= len(all_rows) else []
+            row_email = row[EMAIL_COLUMN - 1].strip().lower() if len(row) >= EMAIL_COLUMN else ""
+            row_username = row[USERNAME_COLUMN - 1].strip().lower() if len(row) >= USERNAME_COLUMN else ""
+            username = data.get('telegram_username', "").strip().lower()
+            if not row_email or not username or row_username != username:
+                logger.info(f"SHEETS: Impossibile recuperare l'email dell'utente {user_id}: la riga {sheet_row} non corrisponde al suo username.")
+                skipped_users += 1
+                continue
+            if row_email in claimed_emails:
+                logger.warning(f"SHEETS: L'email '{row_email}' della riga {sheet_row} è già associata all'utente {claimed_emails[row_email]}. Salto l'utente {user_id}.")
+                skipped_users += 1
+                continue
+            email = row_email
+            data['email'] = email
+            claimed_emails[email] = user_id
+            moved_user_ids.append(user_id)
+            logger.info(f"SHEETS: Email '{email}' recuperata dalla riga {sheet_row} per l'utente {user_id}.")
+        elif claimed_emails.get(email) != user_id:
+            logger.warning(f"SHEETS: L'email '{email}' dell'utente {user_id} è già associata all'utente {claimed_emails[email]}. Salto l'utente.")
+            skipped_users += 1
+            continue
+        if email not in rows_by_email:
+            logger.warning(f"SHEETS: L'utente {user_id} ({email}) non è più presente nel foglio.")
+            continue
+
+        row_number, current_status = rows_by_email[email]
+        if data.get('sheet_row') != row_number:
+            logger.info(f"SHEETS: Riga dell'utente {user_id} aggiornata da {data.get('sheet_row')} a {row_number}.")
+            data['sheet_row'] = row_number
+            if user_id not in moved_user_ids:
+                moved_user_ids.append(user_id)
+
+        expected_status = STATE_TO_ONBOARDING.get(data.get('state'))
+        if (expected_status and row_number not in updated_rows and
+                current_status != expected_status and current_status in BOT_MANAGED_ONBOARDING):
+            updated_rows.add(row_number)
+            cell_updates.append({
+                'range': gspread.utils.rowcol_to_a1(row_number, ONBOARDING_COLUMN),
+                'values': [[expected_status]],
+            })
+
+    if moved_user_ids:
+        context.application.mark_data_for_update_persistence(user_ids=moved_user_ids)
+
+    if cell_updates:
+        try:
+            await worksheet.batch_update(cell_updates)
+        except Exception as e:
+            logger.error(f"SHEETS: Errore durante il batch_update della riconciliazione: {type(e).__name__} - {e}")
+            return
+
+    logger.info(f"SHEETS: Riconciliazione completata. Stati corretti: {len(cell_updates)}, utenti aggiornati: {len(moved_user_ids)}, utenti saltati: {skipped_users}.")
+
+# --- PIPELINE DI ANALISI DEGLI SCREENSHOT ---
+
+# Controlli locali sugli screenshot (valori pensati per screenshot da telefono o desktop)
+SCREENSHOT_MIN_SIDE = 400          # Lato minimo in pixel
+SCREENSHOT_ASPECT_RANGE = (0.3, 2.2)  # Rapporto larghezza/altezza accettato
+# Tutti i candidati fotografano le stesse pagine di TEST_LINKS, quindi il dHash da solo
+# produce falsi positivi: è un indizio debole, il duplicato certo è il controllo esatto.
+NEAR_DUPLICATE_HASH_DISTANCE = 2   # Distanza di Hamming massima per segnalare un quasi-duplicato
+SCREENSHOT_HASH_INDEX_SIZE = 5000  # Numero massimo di hash conservati (i più vecchi vengono scartati)
+SCREENSHOT_ANALYSIS_TIMEOUT = 60   # Secondi di attesa massima dell'analisi prima della notifica finale
+OCR_KEYWORDS = ("review", "stars", "submitted", "thank", "amazon")
+
+# Il lavoro sulle immagini gira in processi separati per non bloccare mai l'event loop.
+# Il pool viene creato in startup_event, con 'spawn' per non fare il fork di un
+# processo che ha già un event loop attivo.
+image_executor = None
+
+# Analisi in corso per utente, così la notifica finale può aspettarle.
+# Non stanno in user_data perché i task non si possono salvare nella persistenza.
+screenshot_tasks = {}
+# Tutti i task in background, da cancellare in shutdown_event
+background_tasks = set()
+
+def start_background_task(coro) -> asyncio.Task:
+    """
+    Avvia un task in background tenendone un riferimento fino alla fine.
+    Non usiamo Application.create_task perché l'applicazione non viene mai
+    avviata con start(): gli update arrivano dal webhook via process_update.
+    """
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def find_duplicate_screenshot(image_hash: int, hash_index: dict, user_id: int):
+    """
+    Cerca nell'indice il dHash più vicino inviato da un altro utente.
+    Restituisce (user_id, distanza) oppure (None, None).
+    """
+    best_owner, best_distance = None, None
+    for known_hash, owner_id in hash_index.items():
+        if not isinstance(known_hash, int) or owner_id == user_id:
+            continue
+        distance = bin(image_hash ^ known_hash).count("1")
+        if best_distance is None or distance < best_distance:
+            best_owner, best_distance = owner_id, distance
+    return best_owner, best_distance
+
+async def process_screenshot(context: ContextTypes.DEFAULT_TYPE, user, chat_id: int, photo_size, user_data: dict) -> None:
+    """
+    Scarica lo screenshot una sola volta, lo analizza nel process pool e invia
+    all'admin la notifica con il punteggio di affidabilità.
+    """
+    try:
+        photo_file = await photo_size.get_file()
+        image_bytes = bytes(await photo_file.download_as_bytearray())
+
+        loop = asyncio.get_running_loop()
+        analysis = await loop.run_in_executor(image_executor, analyze_screenshot, image_bytes, OCR_AVAILABLE)
+    except Exception as e:
+        logger.error(f"Screenshot analysis failed for user {user.id}: {type(e).__name__} - {e}")
+        analysis = None
+
+    notes = []
+    confidence = None
+    if analysis:
+        confidence = 100
+        width, height = analysis['width'], analysis['height']
+        if min(width, height) < SCREENSHOT_MIN_SIDE:
+            confidence -= 30
+            notes.append(f"low resolution ({width}x{height})")
+        aspect_ratio = width / height
+        if not SCREENSHOT_ASPECT_RANGE[0] <= aspect_ratio <= SCREENSHOT_ASPECT_RANGE[1]:
+            confidence -= 20
+            notes.append(f"unusual aspect ratio ({aspect_ratio:.2f})")
+
+        # L'indice degli hash vive in bot_data, quindi viene salvato dalla persistenza.
+        # Chiavi stringa: sha256 dei byte e file_unique_id di Telegram (duplicati esatti).
+        # Chiavi intere: dHash (quasi-duplicati).
+        hash_index = context.application.bot_data.setdefault('screenshot_hashes', {})
+        exact_keys = (f"sha256:{analysis['sha256']}", f"file:{photo_size.file_unique_id}")
+        exact_owner = next((hash_index[key] for key in exact_keys if hash_index.get(key, user.id) != user.id), None)
+        if exact_owner:
+            confidence -= 60
+            notes.append(f"exact duplicate of a screenshot sent by user {exact_owner}")
+        else:
+            near_owner, distance = find_duplicate_screenshot(analysis['hash'], hash_index, user.id)
+            if near_owner and distance <= NEAR_DUPLICATE_HASH_DISTANCE:
+                confidence -= 10
+                notes.append(f"looks similar to a screenshot sent by user {near_owner} (distance {distance})")
+        for key in (*exact_keys, analysis['hash']):
+            hash_index.setdefault(key, user.id)
+        # Il dizionario mantiene l'ordine di inserimento: scartiamo gli hash più vecchi
+        while len(hash_index) > SCREENSHOT_HASH_INDEX_SIZE:
+            del hash_index[next(iter(hash_index))]
+
+        if analysis['ocr_text'] is not None and not any(keyword in analysis['ocr_text'] for keyword in OCR_KEYWORDS):
+            confidence -= 25
+            notes.append("no review-related text found")
+
+        confidence = max(confidence, 0)
+        user_data['screenshot_confidence'] = confidence
+        context.application.mark_data_for_update_persistence(user_ids=[user.id])
+
+    # Invia notifica all'admin
+    if ADMIN_CHAT_ID:
+        try:
+            admin_notification = f"📸 Screenshot received from user {user.full_name} (@{user.username}, ID: {user.id}). Ready for verification."
+            if confidence is not None:
+                admin_notification += f"\nConfidence: {confidence}/100"
+                if notes:
+                    admin_notification += " (" + "; ".join(notes) + ")"
+            else:
+                admin_notification += "\nConfidence: not available (analysis failed)"
+            await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=admin_notification)
+            # Inoltra anche la foto per una verifica più rapida
+            await context.bot.forward_message(chat_id=ADMIN_CHAT_ID, from_chat_id=chat_id, message_id=user_data['photo_message_id'])
+        except Exception as e:
+            logger.error(f"Failed to send notification to admin: {e}")
+
 # --- JOB PER LA CODA (SOLLECITI E SCADENZE) ---
 
 async def reminder_job(context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -290,11 +532,12 @@ async def reminder_job(context: ContextTypes.DEFAULT_TYPE) -> None:
 async def expiration_job(context: ContextTypes.DEFAULT_TYPE) -> None:
     """Imposta lo stato dell'utente a 'expired' dopo 24 ore."""
     job = context.job
-    # Accediamo ai dati dell'utente tramite il persistence layer
-    user_data = await context.application.persistence.get_user_data()
+    # Modifichiamo i dati in memoria dell'applicazione: la persistenza restituisce
+    # solo una copia, e la riconciliazione col foglio legge da qui.
+    user_data = context.application.user_data
     if job.user_id in user_data and user_data[job.user_id].get('state') == 'awaiting_screenshot':
         user_data[job.user_id]['state'] = 'expired'
-        await context.application.persistence.update_user_data(job.user_id, user_data[job.user_id])
+        context.application.mark_data_for_update_persistence(user_ids=[job.user_id])
         logger.info(f"User {job.user_id} has expired.")
 
 # --- GESTORI DI MESSAGGI (HANDLERS) ---
@@ -365,6 +608,7 @@ async def handle_email_submission(update: Update, context: ContextTypes.DEFAULT_
     # --- SE ABBIAMO UNA RIGA, PROCEDIAMO ---
     if sheet_row_number:
         context.user_data['sheet_row'] = sheet_row_number # Fondamentale per gli aggiornamenti futuri!
+        context.user_data['email'] = email_text # Chiave stabile per la riconciliazione col foglio
 
         assigned_link = await get_next_test_link(context)
         context.user_data['state'] = 'awaiting_screenshot'
@@ -436,16 +680,13 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         
     await update.message.reply_text(username_request_message)
 
-    
-    # Invia notifica all'admin
-    if ADMIN_CHAT_ID:
-        try:
-            admin_notification = f"📸 Screenshot received from user {user.full_name} (@{user.username}, ID: {user.id}). Ready for verification."
-            await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=admin_notification)
-            # Inoltra anche la foto per una verifica più rapida
-            await context.bot.forward_message(chat_id=ADMIN_CHAT_ID, from_chat_id=update.effective_chat.id, message_id=update.message.message_id)
-        except Exception as e:
-            logger.error(f"Failed to send notification to admin: {e}")
+    # 4. Analisi dello screenshot e notifica all'admin in background,
+    #    così l'utente riceve subito la risposta. Scarichiamo solo la PhotoSize più grande.
+    task = start_background_task(
+        process_screenshot(context, user, update.effective_chat.id, update.message.photo[-1], context.user_data)
+    )
+    screenshot_tasks[user.id] = task
+    task.add_done_callback(lambda _: screenshot_tasks.pop(user.id, None) if screenshot_tasks.get(user.id) is task else None)
 
 # --- NUOVA FUNZIONE: handle_username ---
 async def handle_username(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -487,7 +728,24 @@ Please try sending it again."""
     # 2. Messaggio di conferma all'utente
     await update.message.reply_text("Perfect, thank you! I've got everything I need. Your application is now with our team for final review. We'll get back to you here shortly. Thanks for your patience!")
 
-    # 3. Invia la notifica completa all'admin
+    # 3. Invia la notifica completa all'admin in background, così il webhook
+    #    risponde subito anche se l'analisi dello screenshot è ancora in corso
+    start_background_task(
+        send_final_admin_notification(context, user, update.effective_chat.id, username_text, context.user_data)
+    )
+
+async def send_final_admin_notification(context: ContextTypes.DEFAULT_TYPE, user, chat_id: int, username_text: str, user_data: dict) -> None:
+    """
+    Invia all'admin la notifica finale dopo l'analisi dello screenshot, così
+    contiene il punteggio e arriva dopo la notifica "📸".
+    """
+    analysis_task = screenshot_tasks.get(user.id)
+    if analysis_task:
+        try:
+            await asyncio.wait_for(asyncio.shield(analysis_task), timeout=SCREENSHOT_ANALYSIS_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Screenshot analysis for user {user.id} not available in time: {type(e).__name__}")
+
     if ADMIN_CHAT_ID:
         try:
             # Recupera l'ID del messaggio della foto per inoltrarlo
@@ -499,6 +757,7 @@ Please try sending it again."""
 **User:** {user.full_name}
 **User ID:** `{user.id}`
 **Provided TG Username:** `{username_text}`
+**Screenshot Confidence:** {f"{user_data['screenshot_confidence']}/100" if 'screenshot_confidence' in user_data else 'n/a'}
 
 Screenshot is attached below.
 """
@@ -507,9 +766,9 @@ Screenshot is attached below.
             
             # Ora inoltra la foto (assumiamo che possiamo trovarla, potremmo doverla salvare)
             # Per renderlo affidabile, modifichiamo un attimo handle_photo
-            photo_message_id = context.user_data.get('photo_message_id')
+            photo_message_id = user_data.get('photo_message_id')
             if photo_message_id:
-                await context.bot.forward_message(chat_id=ADMIN_CHAT_ID, from_chat_id=update.effective_chat.id, message_id=photo_message_id)
+                await context.bot.forward_message(chat_id=ADMIN_CHAT_ID, from_chat_id=chat_id, message_id=photo_message_id)
             else:
                  await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text="Error: Could not retrieve screenshot message ID to forward.")
 
@@ -609,6 +868,9 @@ job_queue.set_application(telegram_app) # Colleghiamo la JobQueue all'app
 # Aggiungiamo l'handler
 telegram_app.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, dispatcher))
 
+# Riconciliazione periodica tra persistenza e Google Sheet
+job_queue.run_repeating(reconciliation_job, interval=RECONCILIATION_INTERVAL, first=60, name="sheet_reconciliation")
+
 # Inizializza l'applicazione web FastAPI
 fastapi_app = FastAPI()
 
@@ -616,6 +878,8 @@ fastapi_app = FastAPI()
 @fastapi_app.on_event("startup")
 async def startup_event():
     
+    global image_executor
+    image_executor = ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("spawn"))
     await telegram_app.initialize()
     await telegram_app.bot.set_webhook(url=f"{WEBHOOK_URL}/{TELEGRAM_TOKEN}", allowed_updates=Update.ALL_TYPES)
     # Avviamo la JobQueue. È sicuro chiamarlo direttamente.
@@ -629,6 +893,12 @@ async def shutdown_event():
     # Stoppiamo la JobQueue. È sicuro chiamarlo direttamente.
     await telegram_app.job_queue.stop()
     await telegram_app.shutdown()
+    # Cancelliamo le analisi e le notifiche ancora in corso prima di chiudere il pool
+    for task in list(background_tasks):
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    if image_executor:
+        image_executor.shutdown(wait=False, cancel_futures=True)
     logger.info("Bot shutdown.")
 
 @fastapi_app.post(f"/{TELEGRAM_TOKEN}")
@@ -0,0 +1,51 @@
+"""
+Analisi degli screenshot eseguita nei processi del pool.
+Questo modulo non deve avere effetti collaterali all'import: i processi
+worker lo re-importano per trovare analyze_screenshot.
+"""
+import io
+import hashlib
+from PIL import Image
+
+# OCR opzionale: se pytesseract non è installato la pipeline salta questo controllo
+try:
+    import pytesseract
+except ImportError:
+    pytesseract = None
+
+OCR_AVAILABLE = pytesseract is not None
+
+def dhash(image: Image.Image) -> int:
+    """dHash a 64 bit: confronta ogni pixel con quello alla sua destra su una miniatura 9x8."""
+    pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    image_hash = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            image_hash = (image_hash << 1) | (left > right)
+    return image_hash
+
+def analyze_screenshot(image_bytes: bytes, run_ocr: bool) -> dict:
+    """
+    Analizza uno screenshot (eseguita nel process pool, quindi deve restare una funzione sincrona).
+    Calcola lo sha256 dei byte e il dHash, misura dimensioni e proporzioni e, se richiesto, esegue l'OCR.
+    """
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        width, height = image.size
+        image_hash = dhash(image)
+
+        ocr_text = None
+        if run_ocr and OCR_AVAILABLE:
+            try:
+                ocr_text = pytesseract.image_to_string(image.convert("L")).lower()
+            except Exception:
+                ocr_text = None
+
+    return {
+        'sha256': hashlib.sha256(image_bytes).hexdigest(),
+        'hash': image_hash,
+        'width': width,
+        'height': height,
+        'ocr_text': ocr_text,
+    }